@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+
+
+def main():
+    """Main function. Subcommands are imported lazily, so that `lookup` doesn't pay for importing boto3."""
+    args = sys.argv[1:]
+
+    if args[:1] == ["lookup"]:
+        from .index import lookup
+        lookup(*args[1:])
+    else:
+        from .main import make_ssh_config
+        make_ssh_config(*args)
+
+
+if __name__ == "__main__":
+    main()
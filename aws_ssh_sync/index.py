@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# NOTE: This module is used by the `lookup` subcommand, which should answer in milliseconds. Don't import boto3 here.
+
+import os
+import sqlite3
+import sys
+
+from argparse import ArgumentParser, SUPPRESS
+from collections import defaultdict
+from contextlib import closing
+
+FIELDS = ["name", "id", "host", "private_address", "public_address", "region", "account"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    config_key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    id TEXT NOT NULL,
+    host TEXT NOT NULL,
+    private_address TEXT,
+    public_address TEXT,
+    region TEXT NOT NULL,
+    account TEXT
+);
+CREATE INDEX IF NOT EXISTS hosts_config_key ON hosts (config_key);
+CREATE INDEX IF NOT EXISTS hosts_name ON hosts (name);
+CREATE INDEX IF NOT EXISTS hosts_id ON hosts (id);
+CREATE INDEX IF NOT EXISTS hosts_private_address ON hosts (private_address);
+CREATE INDEX IF NOT EXISTS hosts_public_address ON hosts (public_address);
+CREATE TABLE IF NOT EXISTS name_assignments (
+    config_key TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    name_index INTEGER NOT NULL,
+    PRIMARY KEY (config_key, scope, id)
+);
+"""
+
+
+def _connect(index_file):
+    """Open an index file, creating the schema if needed"""
+    connection = sqlite3.connect(index_file, timeout=30)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def write_index(index_file, config_key, targets, keep_scopes=()):
+    """Replace all `config_key` entries in the index with a list of SSH targets.
+
+    Entries for `(region, account)` pairs in `keep_scopes` are left as they are (e.g. if they couldn't be synced).
+    """
+    where = "config_key = ?" + "".join(" AND NOT (region = ? AND account IS ?)" for _ in keep_scopes)
+    params = [config_key] + [value for scope in keep_scopes for value in scope]
+
+    with closing(_connect(index_file)) as connection, connection:
+        connection.execute(f"DELETE FROM hosts WHERE {where}", params)
+        connection.executemany(
+            f"INSERT INTO hosts (config_key, {', '.join(FIELDS)}) VALUES (?, {', '.join('?' for _ in FIELDS)})",
+            [[config_key] + [getattr(target, field) for field in FIELDS] for target in targets]
+        )
+
+
+def _indexed_address_ids(index_file, where, params):
+    """Return a set of all `(address, id)` pairs in index rows matching a `where` clause"""
+    if not os.path.exists(index_file):
+        return set()
+
+    with closing(_connect(index_file)) as connection:
+        rows = connection.execute(
+            f"SELECT id, host, private_address, public_address FROM hosts WHERE {where}",
+            params
+        ).fetchall()
+
+    return {(address, instance_id) for instance_id, *addresses in rows for address in addresses if address}
+
+
+def indexed_address_ids(index_file, config_key):
+    """Return a set of all `(address, id)` pairs indexed for `config_key`"""
+    return _indexed_address_ids(index_file, "config_key = ?", (config_key,))
+
+
+def other_indexed_addresses(index_file, config_key):
+    """Return a set of all addresses indexed for any config key other than `config_key`"""
+    return {address for address, _ in _indexed_address_ids(index_file, "config_key != ?", (config_key,))}
+
+
+def assign_name_indexes(index_file, config_key, scope, targets):
+    """Return a stable `id -> name_index` mapping for a list of `(id, name)` pairs.
+
+    Assignments are persisted per `config_key` and `scope`. Instances, that are gone (or renamed), release their index.
+    New instances take the lowest free index for their name, in the order given.
+    """
+    with closing(_connect(index_file)) as connection, connection:
+        assigned = {
+            instance_id: (name, name_index) for instance_id, name, name_index in connection.execute(
+                "SELECT id, name, name_index FROM name_assignments WHERE config_key = ? AND scope = ?",
+                (config_key, scope)
+            )
+        }
+
+        current = dict(targets)
+        released = [instance_id for instance_id, (name, _) in assigned.items() if current.get(instance_id) != name]
+
+        connection.executemany(
+            "DELETE FROM name_assignments WHERE config_key = ? AND scope = ? AND id = ?",
+            [(config_key, scope, instance_id) for instance_id in released]
+        )
+        for instance_id in released:
+            del assigned[instance_id]
+
+        used = defaultdict(set)
+        for name, name_index in assigned.values():
+            used[name].add(name_index)
+
+        added = []
+        for instance_id, name in targets:
+            if instance_id in assigned:
+                continue
+            name_index = 0
+            while name_index in used[name]:
+                name_index += 1
+            used[name].add(name_index)
+            assigned[instance_id] = (name, name_index)
+            added.append((config_key, scope, instance_id, name, name_index))
+
+        connection.executemany(
+            "INSERT INTO name_assignments (config_key, scope, id, name, name_index) VALUES (?, ?, ?, ?, ?)",
+            added
+        )
+
+    return {instance_id: name_index for instance_id, (_, name_index) in assigned.items()}
+
+
+def _prefix_upper_bound(prefix):
+    """Return the smallest string, that is greater than all strings starting with `prefix`"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def find_hosts(index_file, query, config_key=None):
+    """Find hosts matching a name prefix (or a '*' pattern), an instance ID or an address. An empty query matches all."""
+    if not query:
+        # Shell completion starts with an empty word, which matches all names.
+        where = "1"
+        params = []
+    elif any(c in query for c in "*?["):
+        where = "name GLOB ?"
+        params = [query]
+    else:
+        where = "(name >= ? AND name < ?) OR id = ? OR private_address = ? OR public_address = ?"
+        params = [query, _prefix_upper_bound(query), query, query, query]
+
+    if config_key:
+        where = f"({where}) AND config_key = ?"
+        params.append(config_key)
+
+    with closing(_connect(index_file)) as connection:
+        return connection.execute(
+            f"SELECT {', '.join(FIELDS)} FROM hosts WHERE {where} ORDER BY name",
+            params
+        ).fetchall()
+
+
+def _parse_lookup_config(*args):
+    parser = ArgumentParser(
+        prog="aws_ssh_sync lookup",
+        description="Query a host index written by `aws_ssh_sync --index-file`.",
+        add_help=False
+    )
+
+    parser._optionals.title = "Docs"
+    parser.add_argument("-h", "--help",
+                        help="Print this help message and exit.",
+                        action="help",
+                        default=SUPPRESS)
+
+    query_group = parser.add_argument_group("Query")
+    query_group.add_argument("query",
+                             help="Host name prefix, name pattern (use '*' as a wildcard), instance ID or IP address.")
+    query_group.add_argument("-i", "--index-file",
+                             metavar="FILE",
+                             help="Use a specific index file. Falls back to AWS_SSH_SYNC_INDEX.",
+                             default=os.environ.get("AWS_SSH_SYNC_INDEX"))
+    query_group.add_argument("-k", "--config-key",
+                             metavar="KEY",
+                             help="Limit results to a single `config-key`.",
+                             default=None)
+    query_group.add_argument("--field",
+                             help="Print a single field only (e.g. for shell completion).",
+                             choices=FIELDS,
+                             default=None)
+
+    config = parser.parse_args(list(args))
+    if not config.index_file:
+        parser.error("an index file is required (use --index-file or AWS_SSH_SYNC_INDEX)")
+
+    return config
+
+
+def lookup(*args):
+    """Print hosts matching a query."""
+    config = _parse_lookup_config(*args)
+
+    if not os.path.exists(config.index_file):
+        print(f"Index file {config.index_file} doesn't exist.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        for row in find_hosts(config.index_file, config.query, config.config_key):
+            if config.field:
+                print(row[FIELDS.index(config.field)] or "")
+            else:
+                print("\t".join(value or "" for value in row))
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head -1`). Silence the final flush at exit, as suggested by the Python docs.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
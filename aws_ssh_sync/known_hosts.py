@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import re
+import shutil
+import tempfile
+
+HASHED_HOST_MAGIC = "|1|"
+
+PORT_PATTERN = re.compile(r"^\[(.+)\]:[0-9]+$")
+
+
+def _candidates(addresses, port=None):
+    """Return all host names, that ssh may have recorded for a set of addresses"""
+    candidates = set(addresses)
+    if port and str(port) != "22":
+        candidates.update(f"[{address}]:{port}" for address in addresses)
+    return candidates
+
+
+class _HashedHostMatcher():
+    """Match hashed (`|1|salt|hash`) known_hosts entries against a set of candidate host names.
+
+    Each entry uses its own salt, so candidates can't be hashed upfront. Instead, they are encoded once and every salt
+    is keyed once, reusing the HMAC state for each candidate.
+    """
+
+    def __init__(self, candidates):
+        self.candidates = [candidate.encode("utf-8") for candidate in candidates]
+
+    def __call__(self, entry):
+        try:
+            salt_b64, hash_b64 = entry[len(HASHED_HOST_MAGIC):].split("|")
+            salt = base64.b64decode(salt_b64)
+            digest = base64.b64decode(hash_b64)
+        except (ValueError, binascii.Error):
+            return False
+
+        keyed = hmac.new(salt, digestmod=hashlib.sha1)
+        for candidate in self.candidates:
+            mac = keyed.copy()
+            mac.update(candidate)
+            if hmac.compare_digest(mac.digest(), digest):
+                return True
+
+        return False
+
+
+def _prune_line(line, candidates, hashed_matcher):
+    """Return a line without any matching host names, or None if no host names are left"""
+    if not line.strip() or line.lstrip().startswith(("#", "@")):
+        return line
+
+    parts = re.split(r"(\s+)", line, maxsplit=1)
+    if len(parts) < 3:
+        return line
+
+    hosts, separator, rest = parts
+
+    def stale(host):
+        if host.startswith(HASHED_HOST_MAGIC):
+            return hashed_matcher(host)
+        return host in candidates
+
+    kept = [host for host in hosts.split(",") if not stale(host)]
+
+    if not kept:
+        return None
+
+    return f"{','.join(kept)}{separator}{rest}"
+
+
+def prune_known_hosts(known_hosts_file, addresses, port=None):
+    """Remove all entries for given addresses from a known_hosts file. Return the number of changed lines."""
+    known_hosts_file = os.path.expanduser(known_hosts_file)
+
+    if not addresses or not os.path.exists(known_hosts_file):
+        return 0
+
+    candidates = _candidates(addresses, port)
+    hashed_matcher = _HashedHostMatcher(candidates)
+
+    with open(known_hosts_file, "r") as f:
+        lines = f.readlines()
+
+    pruned_lines = [_prune_line(line, candidates, hashed_matcher) for line in lines]
+    changed = sum(1 for line, pruned_line in zip(lines, pruned_lines) if line != pruned_line)
+
+    if not changed:
+        return 0
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(known_hosts_file)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.writelines(line for line in pruned_lines if line is not None)
+    shutil.copymode(known_hosts_file, tmp_file)
+    os.replace(tmp_file, known_hosts_file)
+
+    return changed
@@ -2,24 +2,125 @@
 # -*- coding: utf-8 -*-
 
 import boto3
+import hashlib
+import importlib
+import json
 import os
 import re
 import sys
+import tempfile
+import time
 
 from . import __version__
-from argparse import ArgumentParser, SUPPRESS
+from .index import assign_name_indexes, indexed_address_ids, other_indexed_addresses, write_index
+from .known_hosts import prune_known_hosts
+from argparse import ArgumentParser, ArgumentTypeError, SUPPRESS
+from botocore.exceptions import ClientError
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
 SSHTarget = namedtuple(
     'SSHTarget',
-    'id launch_time name name_index host port user identity_file identities_only server_alive_interval strict_host_key_checking proxy_command'
+    'id launch_time name name_index tags host private_address public_address region account port user identity_file identities_only server_alive_interval strict_host_key_checking proxy_command'
 )
 
+Transform = namedtuple('Transform', 'name function')
+
+TRANSFORMS_ENTRY_POINT_GROUP = "aws_ssh_sync.transforms"
+
+# Refresh cached role credentials, if they expire within this many seconds.
+CREDENTIALS_EXPIRY_MARGIN = 300
+
+ACCOUNT_ID_PATTERN = re.compile(r"^[0-9]{12}$")
+
+
+def _role_arns(config):
+    """Return a list of role ARNs to assume, or `[None]` if the profile should be used directly"""
+    role_arns = list(config.role_arn or [])
+
+    if config.role_arn_file:
+        with open(config.role_arn_file, "r") as f:
+            for line in f:
+                entry = line.split("#", 1)[0].strip()
+                if not entry:
+                    continue
+                if ACCOUNT_ID_PATTERN.match(entry):
+                    entry = f"arn:aws:iam::{entry}:role/{config.role_name}"
+                role_arns.append(entry)
+
+    return list(dict.fromkeys(role_arns)) or [None]
+
+
+def _role_account(role_arn):
+    """Extract an account ID from a role ARN"""
+    return role_arn.split(":")[4] if role_arn else None
+
+
+def _credentials_cache_file(config, role_arn):
+    """Return a cache file location for a given role"""
+    key = hashlib.sha1(f"{config.profile}:{role_arn}".encode("utf-8")).hexdigest()
+    return os.path.join(os.path.expanduser(config.credentials_cache_dir), f"{key}.json")
+
+
+def _role_credentials(config, role_arn):
+    """Return temporary credentials for a given role, using the on-disk cache if possible"""
+    if not role_arn:
+        return None
+
+    cache_file = _credentials_cache_file(config, role_arn)
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                credentials = json.load(f)
+            if credentials["Expiration"] - CREDENTIALS_EXPIRY_MARGIN > time.time():
+                return credentials
+        except (ValueError, KeyError, TypeError):
+            # Treat an unreadable cache entry as a miss. It's replaced below.
+            pass
 
-def _ec2_instances(config, region):
-    """Return a list of running instance descriptors for a given region"""
     session = boto3.session.Session(profile_name=config.profile)
+    sts = session.client("sts")
+
+    response = sts.assume_role(
+        RoleArn=role_arn,
+        RoleSessionName=config.role_session_name
+    )
+
+    credentials = {
+        "AccessKeyId": response["Credentials"]["AccessKeyId"],
+        "SecretAccessKey": response["Credentials"]["SecretAccessKey"],
+        "SessionToken": response["Credentials"]["SessionToken"],
+        "Expiration": response["Credentials"]["Expiration"].timestamp()
+    }
+
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(credentials, f)
+    os.replace(tmp_file, cache_file)
+
+    return credentials
+
+
+def _session(config, credentials=None):
+    """Return a boto3 session for the configured profile, or for a set of temporary credentials"""
+    if not credentials:
+        return boto3.session.Session(profile_name=config.profile)
+
+    return boto3.session.Session(
+        aws_access_key_id=credentials["AccessKeyId"],
+        aws_secret_access_key=credentials["SecretAccessKey"],
+        aws_session_token=credentials["SessionToken"]
+    )
+
+
+def _ec2_instances(config, region, credentials=None):
+    """Return a list of running instance descriptors for a given region"""
+    session = _session(config, credentials)
 
     ec2 = session.client("ec2", region_name=region)
 
@@ -38,7 +139,7 @@ def _ec2_instances(config, region):
     return instance_lists_flatten
 
 
-def _ssh_target(config, region, instance):
+def _ssh_target(config, region, account, instance):
     """Make an SSH target from an EC2 instance"""
 
     def name(instance):
@@ -50,15 +151,18 @@ def _ssh_target(config, region, instance):
         if config.region_prefix:
             base_name = f"{region}-{base_name}"
 
+        if config.account_prefix and account:
+            base_name = f"{account}-{base_name}"
+
         if config.name_prefix:
             base_name = f"{config.name_prefix}{base_name}"
 
         return base_name
 
-    def host(instance):
-        public_addr = instance["PublicIpAddress"] if "PublicIpAddress" in instance else None
-        private_addr = instance["PrivateIpAddress"]
+    public_addr = instance["PublicIpAddress"] if "PublicIpAddress" in instance else None
+    private_addr = instance["PrivateIpAddress"]
 
+    def host(instance):
         if config.address == "public_private":
             return public_addr if public_addr else private_addr
         elif config.address == "public":
@@ -73,7 +177,12 @@ def _ssh_target(config, region, instance):
         launch_time=instance['LaunchTime'],
         name=name(instance),
         name_index=None,
+        tags={t['Key']: t['Value'] for t in instance['Tags'] if 'Key' in t},
         host=host(instance),
+        private_address=private_addr,
+        public_address=public_addr,
+        region=region,
+        account=account,
         port=config.port,
         user=config.user,
         identity_file=config.identity_file,
@@ -84,8 +193,64 @@ def _ssh_target(config, region, instance):
     )
 
 
-def _ssh_targets(config, region):
-    """Fetch a list of indexed SSH targets for a given region."""
+def _entry_points(group):
+    """Return a list of installed entry points for a given group"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+
+    eps = entry_points()
+    return list(eps.select(group=group) if hasattr(eps, "select") else eps.get(group, []))
+
+
+def _load_transform(spec):
+    """Resolve a `module:function` reference or an installed plugin name to a transform"""
+    try:
+        if ":" in spec:
+            module_name, function_name = spec.split(":", 1)
+            return Transform(spec, getattr(importlib.import_module(module_name), function_name))
+
+        for entry_point in _entry_points(TRANSFORMS_ENTRY_POINT_GROUP):
+            if entry_point.name == spec:
+                return Transform(spec, entry_point.load())
+    except (ImportError, AttributeError) as e:
+        raise ArgumentTypeError(f"can't load transform {spec}: {e}")
+
+    raise ArgumentTypeError(f"unknown transform: {spec}")
+
+
+def _apply_transforms(config, targets):
+    """Pass a batch of targets through all transforms in a column-oriented form"""
+    if not config.transform or not targets:
+        return targets
+
+    columns = {field: [getattr(target, field) for target in targets]
+               for field in SSHTarget._fields}
+
+    for transform in config.transform:
+        started = time.perf_counter()
+        changes = transform.function(dict(columns)) or {}
+        elapsed = time.perf_counter() - started
+
+        for field, values in changes.items():
+            if field not in columns:
+                raise ValueError(f"Transform {transform.name} returned an unknown column: {field}")
+            values = list(values)
+            if len(values) != len(targets):
+                raise ValueError(
+                    f"Transform {transform.name} returned {len(values)} values for {field}, expected {len(targets)}")
+            columns[field] = values
+
+        print(f"Transform {transform.name} processed {len(targets)} targets in {elapsed * 1000:.1f} ms.",
+              file=sys.stderr)
+
+    return [SSHTarget(*values) for values in zip(*(columns[field] for field in SSHTarget._fields))]
+
+
+def _ssh_targets(config, region, account=None, credentials=None):
+    """Fetch a list of indexed SSH targets for a given region (and account)."""
 
     def add_index(target_cur, target_prv):
         if target_prv and target_cur.name == target_prv.name:
@@ -106,18 +271,63 @@ def _ssh_targets(config, region):
         fields['name'] = f"{target.name}{target.name_index}"
         return SSHTarget(**fields)
 
-    targets_raw = [_ssh_target(config, region, instance)
-                   for instance in _ec2_instances(config, region)]
-    targets_filtered = [target for target in targets_raw if target.host]
+    targets_raw = [_ssh_target(config, region, account, instance)
+                   for instance in _ec2_instances(config, region, credentials)]
+    targets_transformed = _apply_transforms(config, targets_raw)
+    targets_filtered = [target for target in targets_transformed if target.host]
     targets_sorted = sorted(
         targets_filtered, key=lambda t: (t.name, t.launch_time))
-    targets_indexed = reduce(lambda acc, target: acc + [add_index(target, acc[-1] if len(acc) > 0 else None)],
-                             targets_sorted, [])
+    if config.stable_names:
+        scope = f"{account}/{region}" if account else region
+        name_indexes = assign_name_indexes(config.index_file, config.config_key, scope,
+                                           [(target.id, target.name) for target in targets_sorted])
+        targets_indexed = sorted(
+            [SSHTarget(**dict(target._asdict(), name_index=name_indexes[target.id])) for target in targets_sorted],
+            key=lambda t: (t.name, t.name_index))
+    else:
+        targets_indexed = reduce(lambda acc, target: acc + [add_index(target, acc[-1] if len(acc) > 0 else None)],
+                                 targets_sorted, [])
     targets_renamed = [change_name(target) for target in targets_indexed]
 
     return targets_renamed
 
 
+def _ssh_directives(target):
+    """Return a list of ssh_config directives for a target (except for `HostName`)"""
+    directives = []
+    if target.port:
+        directives.append(f"Port {target.port}")
+    if target.user:
+        directives.append(f"User {target.user}")
+    if target.identity_file:
+        directives.append(f"IdentityFile {target.identity_file}")
+    if target.identities_only:
+        directives.append(f"IdentitiesOnly yes")
+    if target.server_alive_interval:
+        directives.append(f"ServerAliveInterval {target.server_alive_interval}")
+    if not target.strict_host_key_checking:
+        directives.append(f"StrictHostKeyChecking no")
+        directives.append(f"UserKnownHostsFile=/dev/null")
+    if target.proxy_command:
+        directives.append(f"ProxyCommand {target.proxy_command}")
+    return directives
+
+
+def _shared_directives(config, targets):
+    """Return a `Host` pattern matching all targets and a list of directives they have in common.
+
+    The pattern is based on `name_prefix` only. No directives are returned, if any target name doesn't start with it
+    (e.g. after a transform), as the host would lose its directives otherwise.
+    """
+    if not targets or not all(target.name.startswith(config.name_prefix) for target in targets):
+        return None, []
+
+    directive_lists = [_ssh_directives(target) for target in targets]
+    common = set(directive_lists[0]).intersection(*directive_lists[1:])
+
+    return f"{config.name_prefix}*", [directive for directive in directive_lists[0] if directive in common]
+
+
 def _ssh_config_header(config):
     """Return a `config`-based header for the ssh_config"""
     return f"# BEGIN [{config.config_key}]"
@@ -216,7 +426,8 @@ def _parse_config(*args):
 
     parser = ArgumentParser(
         description="Generate ssh_config files from AWS.",
-        epilog="Check ssh_config man page for an output format reference.",
+        epilog=("Check ssh_config man page for an output format reference. "
+                "Run `aws_ssh_sync lookup --help` for querying a host index."),
         add_help=False
     )
 
@@ -251,6 +462,36 @@ def _parse_config(*args):
                            default="public_private",
                            choices=["public_private", "public", "private"])
 
+    # Accounts
+    accounts_group = parser.add_argument_group("Accounts")
+    accounts_group.add_argument("--role-arn",
+                                help="Assume role(s) and sync instances from each account. Uses `profile` as the source.",
+                                metavar="ARN",
+                                nargs="+",
+                                default=None)
+    accounts_group.add_argument("--role-arn-file",
+                                help=("Read role ARNs from a file (one per line). Bare account IDs are expanded "
+                                      "using `role-name`."),
+                                metavar="FILE",
+                                default=None)
+    accounts_group.add_argument("--role-name",
+                                help="Role name used for bare account IDs in `role-arn-file`.",
+                                metavar="NAME",
+                                default="OrganizationAccountAccessRole")
+    accounts_group.add_argument("--role-session-name",
+                                help="Session name used when assuming roles.",
+                                metavar="NAME",
+                                default="aws_ssh_sync")
+    accounts_group.add_argument("--credentials-cache-dir",
+                                help="Cache temporary role credentials in a directory, until shortly before they expire.",
+                                metavar="DIR",
+                                default="~/.aws/aws_ssh_sync/cache")
+    accounts_group.add_argument("--workers",
+                                help="Number of accounts/regions to query concurrently.",
+                                metavar="N",
+                                type=int,
+                                default=8)
+
     # Output
     output_group = parser.add_argument_group("Output")
     output_group.add_argument("-k", "--config-key",
@@ -261,6 +502,16 @@ def _parse_config(*args):
                               metavar="FILE",
                               help=("Specify an output file location. Overwrites relevant `config-key` section "
                                     "in the file, if it exists. Appends a new section otherwise."))
+    output_group.add_argument("--index-file",
+                              metavar="FILE",
+                              help=("Write a host lookup index (SQLite) to a file. Replaces relevant `config-key` "
+                                    "entries, if they exist. Falls back to AWS_SSH_SYNC_INDEX."),
+                              default=os.environ.get("AWS_SSH_SYNC_INDEX"))
+    output_group.add_argument("--factor-directives",
+                              help=("Write directives shared by all hosts once, in a `Host <prefix>*` block placed after "
+                                    "the host blocks. Requires `name-prefix`."),
+                              action="store_true",
+                              default=False)
 
     # SSH
     ssh_group = parser.add_argument_group("SSH")
@@ -268,6 +519,15 @@ def _parse_config(*args):
                            help="Add a region prefix to all SSH host names.",
                            default=False,
                            action="store_true")
+    ssh_group.add_argument("--account-prefix",
+                           help="Add an account prefix to all SSH host names, when assuming roles.",
+                           default=False,
+                           action="store_true")
+    ssh_group.add_argument("--stable-names",
+                           help=("Keep host name indexes stable across runs, instead of re-indexing duplicates by launch "
+                                 "time. New instances take the lowest free index. Requires `index-file`."),
+                           default=False,
+                           action="store_true")
     ssh_group.add_argument("--name-prefix",
                            help="Add a string prefix to all SSH host names.",
                            metavar="PREF",
@@ -298,46 +558,129 @@ def _parse_config(*args):
     ssh_group.add_argument("--proxy-command",
                            help="Provide a ProxyCommand directive.",
                            default=None)
+    ssh_group.add_argument("--prune-known-hosts",
+                           help=("Remove `known_hosts` entries for addresses, that were synced by the previous run, "
+                                 "but no longer exist. Requires `index-file`. Defaults to ~/.ssh/known_hosts."),
+                           metavar="FILE",
+                           nargs="?",
+                           const="~/.ssh/known_hosts",
+                           default=None)
 
-    return parser.parse_args(list(args))
+    # Plugins
+    plugins_group = parser.add_argument_group("Plugins")
+    plugins_group.add_argument("-t", "--transform",
+                               help=("Pass targets through transform(s), one region at a time. Use a `module:function` "
+                                     f"reference or a plugin name registered under `{TRANSFORMS_ENTRY_POINT_GROUP}`."),
+                               metavar="TRANSFORM",
+                               nargs="+",
+                               type=_load_transform,
+                               default=None)
+
+    config = parser.parse_args(list(args))
+    if config.prune_known_hosts and not config.index_file:
+        parser.error("--prune-known-hosts requires --index-file (or AWS_SSH_SYNC_INDEX)")
+    if config.factor_directives and not config.name_prefix:
+        parser.error("--factor-directives requires --name-prefix")
+    if config.workers < 1:
+        parser.error("--workers must be a positive number")
+    if config.stable_names and not config.index_file:
+        parser.error("--stable-names requires --index-file (or AWS_SSH_SYNC_INDEX)")
+
+    return config
 
 
 def make_ssh_config(*args):
     """Make an ssh_config setup."""
     config = _parse_config(*args)
 
+    role_arns = _role_arns(config)
+    jobs = [(role_arn, region) for role_arn in role_arns for region in config.region]
+
+    def role_credentials(role_arn):
+        try:
+            return _role_credentials(config, role_arn), None
+        except ClientError as e:
+            print(f"Can't assume role {role_arn}: {e}", file=sys.stderr)
+            return None, e
+
+    def ssh_targets(job):
+        role_arn, region = job
+        role_credentials, role_error = credentials[role_arn]
+        if role_error:
+            return None
+        try:
+            return _ssh_targets(config, region, _role_account(role_arn), role_credentials)
+        except ClientError as e:
+            print(f"Can't sync {_role_account(role_arn) or config.profile} {region}: {e}", file=sys.stderr)
+            return None
+
+    with ThreadPoolExecutor(max_workers=config.workers) as executor:
+        credentials = dict(zip(role_arns, executor.map(role_credentials, role_arns)))
+        all_results = list(executor.map(ssh_targets, jobs))
+
+    # Skip failed sections, but keep their index entries, so that they aren't treated as gone.
+    failed_scopes = [(region, _role_account(role_arn))
+                     for (role_arn, region), targets in zip(jobs, all_results) if targets is None]
+    synced = [(job, targets) for job, targets in zip(jobs, all_results) if targets is not None]
+    jobs = [job for job, _ in synced]
+    results = [targets for _, targets in synced]
+
+    if config.factor_directives:
+        shared_pattern, shared_directives = _shared_directives(
+            config, [target for targets in results for target in targets])
+    else:
+        shared_pattern, shared_directives = None, []
+
     with _writer(config) as out:
         out(_ssh_config_header(config))
         out(f"# Generated automatically by `aws_ssh_sync`.")
         out(f"")
 
-        for region in config.region:
-            out(f"## {region}")
+        for (role_arn, region), targets in zip(jobs, results):
+            if role_arn:
+                out(f"## {_role_account(role_arn)} {region}")
+            else:
+                out(f"## {region}")
             out("")
 
-            for target in _ssh_targets(config, region):
+            for target in targets:
                 out(f"### {target.id}")
                 out(f"Host {target.name}")
                 out(f"\tHostName {target.host}")
-                if target.port:
-                    out(f"\tPort {target.port}")
-                if target.user:
-                    out(f"\tUser {target.user}")
-                if target.identity_file:
-                    out(f"\tIdentityFile {target.identity_file}")
-                if target.identities_only:
-                    out(f"\tIdentitiesOnly yes")
-                if target.server_alive_interval:
-                    out(f"\tServerAliveInterval {target.server_alive_interval}")
-                if not target.strict_host_key_checking:
-                    out(f"\tStrictHostKeyChecking no")
-                    out(f"\tUserKnownHostsFile=/dev/null")
-                if target.proxy_command:
-                    out(f"\tProxyCommand {target.proxy_command}")
+                for directive in _ssh_directives(target):
+                    if directive not in shared_directives:
+                        out(f"\t{directive}")
                 out("")
 
+        if shared_directives:
+            out(f"## Shared")
+            out("")
+            out(f"Host {shared_pattern}")
+            for directive in shared_directives:
+                out(f"\t{directive}")
+            out("")
+
         out(_ssh_config_footer(config))
 
+    if config.index_file:
+        targets = [target for targets in results for target in targets]
+
+        if config.prune_known_hosts and failed_scopes:
+            print(f"Some accounts/regions failed. Skipping {config.prune_known_hosts} pruning.", file=sys.stderr)
+        elif config.prune_known_hosts:
+            # An address is stale, if the instance that owned it is gone, or if it was reused by another instance.
+            current_address_ids = {(address, target.id) for target in targets
+                                   for address in (target.host, target.private_address, target.public_address)
+                                   if address}
+            previous_address_ids = indexed_address_ids(config.index_file, config.config_key)
+            # Addresses are often reused across accounts, so keep any that are still synced under another key.
+            stale_addresses = ({address for address, _ in previous_address_ids - current_address_ids} -
+                               other_indexed_addresses(config.index_file, config.config_key))
+            pruned = prune_known_hosts(config.prune_known_hosts, stale_addresses, config.port)
+            print(f"Pruned {pruned} stale entries from {config.prune_known_hosts}.", file=sys.stderr)
+
+        write_index(config.index_file, config.config_key, targets, keep_scopes=failed_scopes)
+
 
 def main():
     """Main function"""
@@ -19,7 +19,7 @@ setuptools.setup(
     packages=setuptools.find_namespace_packages(),
     entry_points={
         "console_scripts": [
-            "aws_ssh_sync = aws_ssh_sync.main:main"
+            "aws_ssh_sync = aws_ssh_sync.cli:main"
         ]
     },
     install_requires=["boto3>=1.9"],
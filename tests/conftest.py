@@ -18,10 +18,16 @@ def ec2_client(ec2_region_name):
 
 
 @pytest.fixture(autouse=True)
-def ec2_client_mock(ec2_client, monkeypatch):
+def sts_client(ec2_region_name):
+    yield boto3.client("sts", region_name=ec2_region_name)
+
+
+@pytest.fixture(autouse=True)
+def ec2_client_mock(ec2_client, sts_client, monkeypatch):
+    clients = {"ec2": ec2_client, "sts": sts_client}
     monkeypatch.setattr(boto3.session.Session,
                         "client",
-                        MagicMock(return_value=ec2_client))
+                        MagicMock(side_effect=lambda service, **kwargs: clients[service]))
 
 
 @pytest.fixture(autouse=True)
@@ -29,3 +35,48 @@ def ec2_stub(ec2_client):
     with Stubber(ec2_client) as stubber:
         yield stubber
         stubber.assert_no_pending_responses()
+
+
+@pytest.fixture(autouse=True)
+def sts_stub(sts_client):
+    with Stubber(sts_client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+@pytest.fixture
+def aws_environment(ec2_region_name, monkeypatch):
+    monkeypatch.setenv("AWS_PROFILE", "testprofile")
+    monkeypatch.setenv("AWS_REGION", ec2_region_name)
+
+
+@pytest.fixture
+def add_ec2_instances(ec2_stub):
+    """Queue a `describe_instances` response for `(instance_id, private_ip[, launch_time])` tuples, named `name`."""
+
+    def add_response(instances, name="node"):
+        ec2_stub.add_response(
+            "describe_instances",
+            expected_params={
+                "Filters": [
+                    {"Name": "instance-state-name", "Values": ["running"]}
+                ]
+            },
+            service_response={
+                "Reservations": [
+                    {
+                        "Instances": [
+                            {
+                                "InstanceId": instance_id,
+                                "PrivateIpAddress": private_ip,
+                                "LaunchTime": launch_time[0] if launch_time else "2019-01-01 09:00:00+00:00",
+                                "Tags": [{"Key": "Name", "Value": name}]
+                            }
+                            for instance_id, private_ip, *launch_time in instances
+                        ]
+                    }
+                ]
+            }
+        )
+
+    return add_response
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import pytest
+
 from aws_ssh_sync.main import make_ssh_config
 
 
@@ -199,3 +201,107 @@ def test_no_instances_to_stdout(ec2_stub, ec2_region_name, capsys, monkeypatch):
 
 # END [testprofile]
 """
+
+
+def test_factored_config_to_stdout(ec2_stub, ec2_region_name, capsys):
+    ec2_stub.add_response(
+        "describe_instances",
+        expected_params={
+            "Filters": [
+                {"Name": "instance-state-name", "Values": ["running"]}
+            ]
+        },
+        service_response={
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": "i-1",
+                            "PrivateIpAddress": "192.168.0.1",
+                            "LaunchTime": "2018-01-01 09:00:00+00:00",
+                            "Tags": [{"Key": "Name", "Value": "node"}]
+                        },
+                        {
+                            "InstanceId": "i-2",
+                            "PrivateIpAddress": "192.168.0.2",
+                            "LaunchTime": "2019-01-01 09:00:00+00:00",
+                            "Tags": [{"Key": "Name", "Value": "node"}]
+                        }
+                    ]
+                }
+            ]
+        }
+    )
+
+    make_ssh_config(
+        "--profile", "testprofile",
+        "--region", ec2_region_name,
+        "--config-key", "test_key",
+        "--name-prefix", "test-",
+        "--user", "tester",
+        "--identity-file", "~/.ssh/id_rsa.test",
+        "--skip-strict-host-checking",
+        "--factor-directives"
+    )
+
+    out, err = capsys.readouterr()
+
+    assert err == ""
+    assert out == f"""\
+# BEGIN [test_key]
+# Generated automatically by `aws_ssh_sync`.
+
+## {ec2_region_name}
+
+### i-1
+Host test-node0
+\tHostName 192.168.0.1
+
+### i-2
+Host test-node1
+\tHostName 192.168.0.2
+
+## Shared
+
+Host test-*
+\tUser tester
+\tIdentityFile ~/.ssh/id_rsa.test
+\tIdentitiesOnly yes
+\tStrictHostKeyChecking no
+\tUserKnownHostsFile=/dev/null
+
+# END [test_key]
+"""
+
+
+def test_factored_config_requires_name_prefix(capsys):
+
+    # `web0` and `worker0` only share an accidental prefix, which would match e.g. `www.example.com` as well.
+    with pytest.raises(SystemExit) as wrapped_exception:
+        make_ssh_config("--region", "eu-central-1", "--factor-directives")
+
+    assert wrapped_exception.value.code == 2
+
+    out, err = capsys.readouterr()
+
+    assert out == ""
+    assert "--factor-directives requires --name-prefix" in err
+
+
+def test_factored_config_ignores_accidental_prefix(add_ec2_instances, ec2_region_name, capsys):
+    add_ec2_instances([("i-1", "192.168.0.1")], name="web")
+    add_ec2_instances([("i-2", "192.168.0.2")], name="worker")
+
+    make_ssh_config(
+        "--profile", "testprofile",
+        "--region", ec2_region_name, "us-east-1",
+        "--name-prefix", "prod-",
+        "--workers", "1",
+        "--factor-directives"
+    )
+
+    out, err = capsys.readouterr()
+
+    assert err == ""
+    assert "Host prod-*\n" in out
+    assert "Host prod-w*" not in out
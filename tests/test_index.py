@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import subprocess
+import sys
+
+from aws_ssh_sync.index import lookup, write_index
+from aws_ssh_sync.main import SSHTarget, make_ssh_config
+
+
+@pytest.fixture
+def _index_file(ec2_stub, ec2_region_name, monkeypatch, tmp_path):
+    monkeypatch.setenv("AWS_PROFILE", "testprofile")
+    monkeypatch.setenv("AWS_REGION", ec2_region_name)
+
+    ec2_stub.add_response(
+        "describe_instances",
+        expected_params={
+            "Filters": [
+                {"Name": "instance-state-name", "Values": ["running"]}
+            ]
+        },
+        service_response={
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": "i-1",
+                            "PrivateIpAddress": "192.168.0.1",
+                            "PublicIpAddress": "42.42.42.42",
+                            "LaunchTime": "2017-01-01 09:00:00+00:00",
+                            "Tags": [{"Key": "Name", "Value": "web-prod"}]
+                        },
+                        {
+                            "InstanceId": "i-2",
+                            "PrivateIpAddress": "192.168.0.2",
+                            "LaunchTime": "2018-01-01 09:00:00+00:00",
+                            "Tags": [{"Key": "Name", "Value": "web-prod"}]
+                        },
+                        {
+                            "InstanceId": "i-3",
+                            "PrivateIpAddress": "192.168.0.3",
+                            "LaunchTime": "2019-01-01 09:00:00+00:00",
+                            "Tags": [{"Key": "Name", "Value": "db-prod"}]
+                        }
+                    ]
+                }
+            ]
+        }
+    )
+
+    index_file = tmp_path / "hosts.db"
+
+    make_ssh_config(
+        "-o", str(tmp_path / "ssh_test.conf"),
+        "--index-file", str(index_file)
+    )
+
+    yield index_file
+
+
+def test_lookup_by_name_prefix(_index_file, ec2_region_name, capsys):
+    capsys.readouterr()
+
+    lookup("--index-file", str(_index_file), "web")
+
+    out, err = capsys.readouterr()
+
+    assert err == ""
+    assert out == f"""\
+web-prod0\ti-1\t42.42.42.42\t192.168.0.1\t42.42.42.42\t{ec2_region_name}\t
+web-prod1\ti-2\t192.168.0.2\t192.168.0.2\t\t{ec2_region_name}\t
+"""
+
+
+def test_lookup_by_pattern(_index_file, capsys):
+    capsys.readouterr()
+
+    lookup("--index-file", str(_index_file), "--field", "name", "*-prod*")
+
+    out, err = capsys.readouterr()
+
+    assert err == ""
+    assert out == "db-prod0\nweb-prod0\nweb-prod1\n"
+
+
+def test_lookup_with_empty_query(_index_file, capsys):
+    capsys.readouterr()
+
+    lookup("--index-file", str(_index_file), "--field", "name", "")
+
+    out, err = capsys.readouterr()
+
+    assert err == ""
+    assert out == "db-prod0\nweb-prod0\nweb-prod1\n"
+
+
+@pytest.mark.parametrize("query", ["i-3", "192.168.0.3"])
+def test_lookup_by_id_or_address(_index_file, query, capsys):
+    capsys.readouterr()
+
+    lookup("--index-file", str(_index_file), "--field", "name", query)
+
+    out, err = capsys.readouterr()
+
+    assert err == ""
+    assert out == "db-prod0\n"
+
+
+def test_lookup_by_config_key(_index_file, capsys):
+    capsys.readouterr()
+
+    lookup("--index-file", str(_index_file), "--config-key", "otherprofile", "web")
+
+    out, err = capsys.readouterr()
+
+    assert err == ""
+    assert out == ""
+
+
+def test_lookup_does_not_import_boto3():
+    code = ("import sys; import aws_ssh_sync.cli, aws_ssh_sync.index; "
+            "sys.exit(1 if 'boto3' in sys.modules else 0)")
+
+    assert subprocess.run([sys.executable, "-c", code]).returncode == 0
+
+
+def test_failed_regions_keep_index_entries(_index_file, ec2_stub, ec2_region_name, capsys, tmp_path):
+    ec2_stub.add_client_error("describe_instances", service_error_code="RequestLimitExceeded")
+
+    make_ssh_config(
+        "-o", str(tmp_path / "ssh_test.conf"),
+        "--index-file", str(_index_file)
+    )
+
+    capsys.readouterr()
+
+    lookup("--index-file", str(_index_file), "--field", "name", "")
+
+    out, err = capsys.readouterr()
+
+    assert out == "db-prod0\nweb-prod0\nweb-prod1\n"
+
+
+def test_lookup_to_closed_pipe(tmp_path):
+    index_file = tmp_path / "hosts.db"
+    write_index(str(index_file), "testprofile", [
+        SSHTarget(**dict({field: None for field in SSHTarget._fields},
+                         name=f"node{i}", id=f"i-{i}", host=f"10.0.{i // 256}.{i % 256}", region="eu-central-1"))
+        for i in range(50000)
+    ])
+
+    lookup_process = subprocess.Popen(
+        [sys.executable, "-m", "aws_ssh_sync.cli", "lookup", "--index-file", str(index_file), ""],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    lookup_process.stdout.readline()
+    lookup_process.stdout.close()
+
+    assert lookup_process.stderr.read() == b""
+    lookup_process.wait()
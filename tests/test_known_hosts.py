@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import hmac
+import os
+import pytest
+
+from aws_ssh_sync.main import make_ssh_config
+
+
+def _hashed(host, salt=b"0123456789abcdefghij"):
+    digest = hmac.new(salt, host.encode("utf-8"), hashlib.sha1).digest()
+    return f"|1|{base64.b64encode(salt).decode()}|{base64.b64encode(digest).decode()}"
+
+
+def test_prune_known_hosts(aws_environment, add_ec2_instances, tmp_path, capsys):
+    index_file = tmp_path / "hosts.db"
+    known_hosts_file = tmp_path / "known_hosts"
+
+    add_ec2_instances([("i-1", "10.0.0.1"), ("i-2", "10.0.0.2"), ("i-3", "10.0.0.3")])
+    add_ec2_instances([("i-1", "10.0.0.1"), ("i-4", "10.0.0.4")])
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+
+    known_hosts_file.write_text(f"""\
+# Comment 10.0.0.2
+10.0.0.1 ssh-ed25519 AAAA1
+10.0.0.2 ssh-ed25519 AAAA2
+10.0.0.3,10.9.9.9 ssh-ed25519 AAAA3
+{_hashed("10.0.0.1")} ssh-ed25519 AAAA4
+{_hashed("10.0.0.2")} ssh-ed25519 AAAA5
+@cert-authority 10.0.0.2 ssh-ed25519 AAAA6
+10.9.9.9\tssh-ed25519 AAAA7
+""")
+    os.chmod(known_hosts_file, 0o600)
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+
+    assert known_hosts_file.read_text() == f"""\
+# Comment 10.0.0.2
+10.0.0.1 ssh-ed25519 AAAA1
+10.9.9.9 ssh-ed25519 AAAA3
+{_hashed("10.0.0.1")} ssh-ed25519 AAAA4
+@cert-authority 10.0.0.2 ssh-ed25519 AAAA6
+10.9.9.9\tssh-ed25519 AAAA7
+"""
+    assert os.stat(known_hosts_file).st_mode & 0o777 == 0o600
+
+    out, err = capsys.readouterr()
+
+    assert "Pruned 3 stale entries" in err
+
+
+def test_prune_known_hosts_with_port(aws_environment, add_ec2_instances, tmp_path):
+    index_file = tmp_path / "hosts.db"
+    known_hosts_file = tmp_path / "known_hosts"
+
+    add_ec2_instances([("i-1", "10.0.0.1"), ("i-2", "10.0.0.2")])
+    add_ec2_instances([("i-1", "10.0.0.1")])
+
+    args = ["--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file), "--port", "2222"]
+
+    make_ssh_config(*args)
+
+    known_hosts_file.write_text(f"""\
+[10.0.0.1]:2222 ssh-ed25519 AAAA1
+[10.0.0.2]:2222 ssh-ed25519 AAAA2
+{_hashed("[10.0.0.2]:2222")} ssh-ed25519 AAAA3
+""")
+
+    make_ssh_config(*args)
+
+    assert known_hosts_file.read_text() == "[10.0.0.1]:2222 ssh-ed25519 AAAA1\n"
+
+
+def test_prune_known_hosts_requires_index(capsys):
+
+    with pytest.raises(SystemExit) as wrapped_exception:
+        make_ssh_config("--region", "eu-central-1", "--prune-known-hosts")
+
+    assert wrapped_exception.value.code == 2
+
+
+def test_prune_known_hosts_keeps_addresses_of_other_config_keys(aws_environment, add_ec2_instances, tmp_path):
+    index_file = tmp_path / "hosts.db"
+    known_hosts_file = tmp_path / "known_hosts"
+
+    add_ec2_instances([("i-1", "10.0.0.1"), ("i-2", "10.0.0.2")])
+    add_ec2_instances([("i-9", "10.0.0.2")])
+    add_ec2_instances([("i-1", "10.0.0.1")])
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+    make_ssh_config("--index-file", str(index_file), "--config-key", "other")
+
+    known_hosts_file.write_text("10.0.0.2 ssh-ed25519 AAAA1\n")
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+
+    assert known_hosts_file.read_text() == "10.0.0.2 ssh-ed25519 AAAA1\n"
+
+
+def test_prune_known_hosts_with_reused_address(aws_environment, add_ec2_instances, tmp_path):
+    index_file = tmp_path / "hosts.db"
+    known_hosts_file = tmp_path / "known_hosts"
+
+    add_ec2_instances([("i-1", "10.0.0.5"), ("i-2", "10.0.0.6")])
+    add_ec2_instances([("i-9", "10.0.0.5"), ("i-2", "10.0.0.6")])
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+
+    known_hosts_file.write_text("""\
+10.0.0.5 ssh-ed25519 AAAA1
+10.0.0.6 ssh-ed25519 AAAA2
+""")
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+
+    assert known_hosts_file.read_text() == "10.0.0.6 ssh-ed25519 AAAA2\n"
+
+
+def test_prune_known_hosts_skipped_on_failure(aws_environment, add_ec2_instances, ec2_stub, tmp_path, capsys):
+    index_file = tmp_path / "hosts.db"
+    known_hosts_file = tmp_path / "known_hosts"
+
+    add_ec2_instances([("i-1", "10.0.0.1")])
+    ec2_stub.add_client_error("describe_instances", service_error_code="RequestLimitExceeded")
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+
+    known_hosts_file.write_text("10.0.0.1 ssh-ed25519 AAAA1\n")
+
+    make_ssh_config("--index-file", str(index_file), "--prune-known-hosts", str(known_hosts_file))
+
+    assert known_hosts_file.read_text() == "10.0.0.1 ssh-ed25519 AAAA1\n"
+
+    out, err = capsys.readouterr()
+
+    assert "Skipping" in err
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from aws_ssh_sync.main import make_ssh_config
+
+
+def _hosts(out):
+    return [line for line in out.splitlines() if line.startswith(("###", "Host "))]
+
+
+def test_stable_names(aws_environment, add_ec2_instances, tmp_path, capsys):
+    args = ["--index-file", str(tmp_path / "hosts.db"), "--stable-names"]
+
+    add_ec2_instances([
+        ("i-1", "192.168.0.1", "2017-01-01 09:00:00+00:00"),
+        ("i-2", "192.168.0.2", "2018-01-01 09:00:00+00:00"),
+        ("i-3", "192.168.0.3", "2019-01-01 09:00:00+00:00")
+    ], name="clusterfoo")
+    # i-1 terminated
+    add_ec2_instances([
+        ("i-2", "192.168.0.2", "2018-01-01 09:00:00+00:00"),
+        ("i-3", "192.168.0.3", "2019-01-01 09:00:00+00:00")
+    ], name="clusterfoo")
+    # i-4 and i-5 launched
+    add_ec2_instances([
+        ("i-2", "192.168.0.2", "2018-01-01 09:00:00+00:00"),
+        ("i-3", "192.168.0.3", "2019-01-01 09:00:00+00:00"),
+        ("i-4", "192.168.0.4", "2020-01-01 09:00:00+00:00"),
+        ("i-5", "192.168.0.5", "2020-02-01 09:00:00+00:00")
+    ], name="clusterfoo")
+
+    make_ssh_config(*args)
+    assert _hosts(capsys.readouterr().out) == [
+        "### i-1", "Host clusterfoo0",
+        "### i-2", "Host clusterfoo1",
+        "### i-3", "Host clusterfoo2"
+    ]
+
+    make_ssh_config(*args)
+    assert _hosts(capsys.readouterr().out) == [
+        "### i-2", "Host clusterfoo1",
+        "### i-3", "Host clusterfoo2"
+    ]
+
+    make_ssh_config(*args)
+    assert _hosts(capsys.readouterr().out) == [
+        "### i-4", "Host clusterfoo0",
+        "### i-2", "Host clusterfoo1",
+        "### i-3", "Host clusterfoo2",
+        "### i-5", "Host clusterfoo3"
+    ]
+
+
+def test_stable_names_requires_index(capsys):
+
+    with pytest.raises(SystemExit) as wrapped_exception:
+        make_ssh_config("--region", "eu-central-1", "--stable-names")
+
+    assert wrapped_exception.value.code == 2
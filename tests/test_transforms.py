@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from aws_ssh_sync.main import make_ssh_config
+
+
+def role_names(columns):
+    return {
+        "name": [tags.get("Role", name) for name, tags in zip(columns["name"], columns["tags"])]
+    }
+
+
+def bastion_users(columns):
+    return {
+        "user": ["admin" if name == "bastion" else user for name, user in zip(columns["name"], columns["user"])]
+    }
+
+
+def drop_untagged(columns):
+    return {
+        "host": [host if tags else None for host, tags in zip(columns["host"], columns["tags"])]
+    }
+
+
+def truncate(columns):
+    return {"name": columns["name"][:1]}
+
+
+@pytest.fixture
+def _transform_requests(ec2_stub, ec2_region_name, monkeypatch):
+    monkeypatch.setenv("AWS_PROFILE", "testprofile")
+    monkeypatch.setenv("AWS_REGION", ec2_region_name)
+
+    ec2_stub.add_response(
+        "describe_instances",
+        expected_params={
+            "Filters": [
+                {"Name": "instance-state-name", "Values": ["running"]}
+            ]
+        },
+        service_response={
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": "i-1",
+                            "PrivateIpAddress": "192.168.0.1",
+                            "LaunchTime": "2017-01-01 09:00:00+00:00",
+                            "Tags": []
+                        },
+                        {
+                            "InstanceId": "i-2",
+                            "PrivateIpAddress": "192.168.0.2",
+                            "LaunchTime": "2018-01-01 09:00:00+00:00",
+                            "Tags": [{"Key": "Name", "Value": "clusterfoo"}, {"Key": "Role", "Value": "bastion"}]
+                        },
+                        {
+                            "InstanceId": "i-3",
+                            "PrivateIpAddress": "192.168.0.3",
+                            "LaunchTime": "2019-01-01 09:00:00+00:00",
+                            "Tags": [{"Key": "Name", "Value": "clusterfoo"}]
+                        }
+                    ]
+                }
+            ]
+        }
+    )
+
+
+def test_transforms_to_stdout(_transform_requests, ec2_region_name, capsys):
+
+    make_ssh_config(
+        "--transform",
+        "tests.test_transforms:drop_untagged",
+        "tests.test_transforms:role_names",
+        "tests.test_transforms:bastion_users"
+    )
+
+    out, err = capsys.readouterr()
+
+    assert out == f"""\
+# BEGIN [testprofile]
+# Generated automatically by `aws_ssh_sync`.
+
+## {ec2_region_name}
+
+### i-2
+Host bastion0
+\tHostName 192.168.0.2
+\tUser admin
+\tIdentitiesOnly yes
+
+### i-3
+Host clusterfoo0
+\tHostName 192.168.0.3
+\tUser ec2-user
+\tIdentitiesOnly yes
+
+# END [testprofile]
+"""
+
+    timings = err.splitlines()
+    assert len(timings) == 3
+    assert timings[0].startswith("Transform tests.test_transforms:drop_untagged processed 3 targets in ")
+
+
+def test_transform_with_invalid_column_length(_transform_requests):
+
+    with pytest.raises(ValueError):
+        make_ssh_config("--transform", "tests.test_transforms:truncate")
+
+
+def test_unknown_transform(capsys):
+
+    with pytest.raises(SystemExit) as wrapped_exception:
+        make_ssh_config("--region", "eu-central-1", "--transform", "no-such-plugin")
+
+    assert wrapped_exception.value.code == 2
+
+    out, err = capsys.readouterr()
+
+    assert "unknown transform: no-such-plugin" in err